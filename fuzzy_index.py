@@ -1,23 +1,29 @@
 #!/usr/bin/env python3
 
-import csv
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from math import fabs
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from time import monotonic
 from queue import Queue
 import re
 
-import psycopg2
-from joblib import parallel_backend
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from unidecode import unidecode
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
 
-# For wolf
-DB_CONNECT = "dbname=musicbrainz_db user=musicbrainz host=localhost port=5432 password=musicbrainz"
 ARTIST_CONFIDENCE_THRESHOLD = .7
 CHUNK_SIZE = 100000
+# Indexes smaller than this are searched with a sparse dot product instead of nmslib
+BRUTE_FORCE_THRESHOLD = 1000
+# TOTUNE: k might need tuning
+MAX_RESULTS = 3
+# Dense dimensions the artist index vectors are projected down to for HNSW
+PROJECTION_DIMS = 128
+# TOTUNE: candidates fetched from HNSW per query, which are then rescored exactly
+HNSW_CANDIDATES = 20
 
 try:
     import nmslib
@@ -27,42 +33,87 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
-def ngrams(string, n=3):
-    """ Take a lookup string (noise removed, lower case, etc) and turn into a list of trigrams """
+# Stateless, so one instance is shared by every index. char_wb pads each word with a space,
+# which gives the same trigrams as padding the lookup string by hand. Strings are lower cased
+# by encode_string already, so skip the vectorizer's own lower casing pass. nmslib works in
+# float32 anyway, so storing float32 halves the memory moved by the brute force searches.
+VECTORIZER = HashingVectorizer(analyzer='char_wb',
+                               ngram_range=(3, 3),
+                               lowercase=False,
+                               n_features=2**18,
+                               norm='l2',
+                               alternate_sign=False,
+                               dtype=np.float32)
 
-    string = ' ' + string + ' '  # pad names for ngrams...
-    ngrams = zip(*[string[i:] for i in range(n)])
-    return [''.join(ngram) for ngram in ngrams]
+# Strips punctuation and spaces in a single pass
+STRIP_RE = re.compile(r'[^\w]+')
+
+
+@lru_cache(maxsize=200_000)
+def encode_string(text):
+    """ Remove noise from a string and lower case it, transliterating it to ASCII if needed. """
+    if text is None:
+        return None
+    text = STRIP_RE.sub('', text).lower()
+    if text.isascii():
+        return text
+
+    from unidecode import unidecode
+    return unidecode(text)
+
+
+def encode_strings(values):
+    """
+        Encode an array of strings at ingest. These are mostly distinct, so encode_string's cache
+        would nearly always miss; instead each unique value is encoded once, bypassing the cache,
+        and the results are mapped back. The cache is left for query time lookups.
+    """
+
+    codes, uniques = pd.factorize(values)
+    encoded = np.array([encode_string.__wrapped__(value) for value in uniques], dtype=object)
+    return encoded[codes]
 
 
 class FuzzyIndex:
     '''
-       Create a fuzzy index using a Term Frequency, Inverse Document Frequency (tf-idf)
-       algorithm. Currently the libraries that implement this cannot be serialized to disk,
+       Create a fuzzy index using L2 normalized, hashed character trigram vectors.
+       Currently the libraries that implement this cannot be serialized to disk,
        so this is an in memory operation. Fortunately for our amounts of data, it should
        be quick to rebuild this index.
     '''
 
+    vectorizer = VECTORIZER
+
     def __init__(self):
         global have_nmslib
 
         self.have_nmslib = have_nmslib
-        self.vectorizer = None
+        self.lookup_matrix = None
+        self.lookup_matrix_t = None
+        self.lookup_ids = None
         self.index = None
 
-    @staticmethod
-    def encode_string(text):
-        if text is None:
-            return None
-        return unidecode(re.sub(" +", "", re.sub(r'[^\w ]+', '', text)).strip().lower())
-
     def build(self, search_data):
         """
             Builds a new index and saves it to disk and keeps it in ram as well.
         """
 
-        if not self.have_nmslib:
-            return
+        self.vectorize(search_data)
+        self.create_index()
+
+    def load(self, lookup_matrix, lookup_ids):
+        """
+            Builds a new index from lookup data that has already been vectorized.
+        """
+
+        self.lookup_matrix = lookup_matrix
+        self.lookup_ids = lookup_ids
+        self.create_index()
+
+    def vectorize(self, search_data):
+        """
+            Turn the (lookup_string, lookup_id) pairs into the sparse lookup matrix.
+        """
 
         lookup_strings = []
         lookup_ids = []
@@ -70,47 +121,204 @@ class FuzzyIndex:
             lookup_strings.append(value)
             lookup_ids.append(lookup_id)
 
-        self.vectorizer = TfidfVectorizer(min_df=1, analyzer=ngrams)
-        # This function's performance degrades over time, despite only ever working on small indexes. WTF?
-        lookup_matrix = self.vectorizer.fit_transform(lookup_strings)
+        self.lookup_matrix = self.vectorizer.transform(lookup_strings)
+        self.lookup_ids = lookup_ids
+
+    def create_index(self):
+        """
+            Create the nmslib index from the vectorized lookup data. Small indexes skip nmslib
+            altogether, since its per query overhead outweighs scanning a few hundred rows.
+        """
+
+        if len(self.lookup_ids) >= BRUTE_FORCE_THRESHOLD and not self.have_nmslib:
+            logger.warning("nmslib not installed, falling back to a slow brute force search. Install nmslib!")
+
+        if len(self.lookup_ids) < BRUTE_FORCE_THRESHOLD or not self.have_nmslib:
+            # Transpose once here: transposing per query allocates an indptr the size of the
+            # whole feature space on every call.
+            self.lookup_matrix_t = self.lookup_matrix.T.tocsr()
+            self.lookup_matrix = None
+            self.lookup_ids = np.asarray(self.lookup_ids)
+            return
 
         self.index = nmslib.init(method='simple_invindx',
                                  space='negdotprod_sparse_fast',
                                  data_type=nmslib.DataType.SPARSE_VECTOR)
-        self.index.addDataPointBatch(lookup_matrix, lookup_ids)
+        self.index.addDataPointBatch(self.lookup_matrix, self.lookup_ids)
         self.index.createIndex()
 
-    def search(self, query_string):
+        # nmslib keeps its own copy of the data
+        self.lookup_matrix = None
+        self.lookup_ids = None
+
+    def search(self, query_strings):
         """
-            Return IDs for the matches in a list. Returns a list of dicts with keys of lookup_string, confidence and recording_id.
+            Return IDs for the matches of each query string, using a single batched query. Returns a list
+            with one entry per query string, each a list of dicts with keys of text, confidence and id.
         """
-        if not self.have_nmslib:
-            logger.warning("nmslib not installed and trying fuzzy search, but nothing will match. Install nmslib!")
-            return []
-
-        query_matrix = self.vectorizer.transform([query_string])
-        # TOTUNE: k might need tuning
-        results = self.index.knnQueryBatch(query_matrix, k=3, num_threads=5)
 
         output = []
-        for index, conf in zip(results[0][0], results[0][1]):
-            output.append({"confidence": fabs(conf), "id": index, "text": query_string })
+        for query_string, (ids, confidences) in zip(query_strings, self.match(query_strings)):
+            output.append([{"confidence": conf, "id": index, "text": query_string}
+                           for index, conf in zip(ids.tolist(), confidences.tolist())])
 
         return output
 
-def build_index(thread_data):
-    rows = 0
+    def match(self, query_strings):
+        """
+            Like search, but returns a pair of (ids, confidences) arrays for each query string,
+            best match first, so callers can avoid building intermediate dicts.
+        """
+
+        return self.match_vectors(self.vectorizer.transform(query_strings))
+
+    def match_vectors(self, query_matrix):
+        """
+            Like match, for queries that have already been vectorized.
+        """
+
+        if self.index is None:
+            return match_matrix(self.lookup_matrix_t, self.lookup_ids, query_matrix)
+
+        results = self.index.knnQueryBatch(query_matrix, k=MAX_RESULTS, num_threads=5)
+        return [(ids, np.abs(distances)) for ids, distances in results]
+
+
+class ArtistIndex(FuzzyIndex):
+    '''
+       A FuzzyIndex for the large artist name corpus. simple_invindx scans whole posting lists
+       per query, which grows with the corpus, so the trigram vectors are reduced to PROJECTION_DIMS
+       dense dimensions with a random projection and searched with an HNSW graph instead. The
+       projected cosine is only an estimate, so HNSW just finds candidates, which are rescored
+       against the exact trigram vectors.
+
+       The projection is a count sketch: each hashed trigram feature is added to one random dimension
+       with a random sign. Trigram vectors are too sparse for sklearn's SparseRandomProjection at its
+       default density, and a dense projection of 2**18 features would take hundreds of MB.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.projection = None
+
+    def create_index(self):
+        """
+            Create the HNSW index from the vectorized lookup data. Small indexes, or no nmslib,
+            fall back to the brute force search like any other FuzzyIndex.
+        """
+
+        if len(self.lookup_ids) < BRUTE_FORCE_THRESHOLD or not self.have_nmslib:
+            super().create_index()
+            return
+
+        n_features = self.lookup_matrix.shape[1]
+        rng = np.random.default_rng(0)
+        self.projection = csr_matrix((rng.choice([-1.0, 1.0], n_features).astype(np.float32),
+                                      (np.arange(n_features), rng.integers(0, PROJECTION_DIMS, n_features))),
+                                     shape=(n_features, PROJECTION_DIMS))
+
+        # HNSW ids are row numbers, so the candidates can be rescored from lookup_matrix
+        self.lookup_ids = np.asarray(self.lookup_ids)
+        self.index = nmslib.init(method='hnsw', space='cosinesimil')
+        self.index.addDataPointBatch(self._project(self.lookup_matrix), np.arange(len(self.lookup_ids)))
+        # TOTUNE: M and efConstruction trade build time for recall
+        self.index.createIndex({'M': 16, 'efConstruction': 200})
+        self.index.setQueryTimeParams({'efSearch': 100})
+
+    def match_vectors(self, query_matrix):
+        """
+            Return a pair of (ids, confidences) arrays for each vectorized query, best match first.
+        """
+
+        if self.index is None:
+            return super().match_vectors(query_matrix)
+
+        query_vectors = self._project(query_matrix)
+        results = self.index.knnQueryBatch(query_vectors, k=HNSW_CANDIDATES, num_threads=5)
+
+        if not results:
+            return []
+
+        # Rescore every (candidate row, query) pair in a single sparse pass. Queries that got
+        # fewer candidates are padded with row 0, scored as 0 so top_matches drops them.
+        candidates = np.zeros((len(results), max(len(rows) for rows, _ in results)), dtype=np.int64)
+        found = np.zeros(candidates.shape, dtype=bool)
+        for query_row, (rows, _) in enumerate(results):
+            candidates[query_row, :len(rows)] = rows
+            found[query_row, :len(rows)] = True
+
+        query_rows = np.repeat(np.arange(len(results)), candidates.shape[1])
+        scores = np.asarray(self.lookup_matrix[candidates.ravel()]
+                            .multiply(query_matrix[query_rows])
+                            .sum(axis=1)).reshape(candidates.shape)
+        scores[~found] = 0
+
+        return top_matches(scores, self.lookup_ids[candidates])
+
+    def _project(self, matrix):
+        """
+            Project sparse trigram vectors to L2 normalized dense float32 vectors.
+        """
+
+        return normalize((matrix @ self.projection).toarray())
+
+
+def match_matrix(lookup_matrix_t, lookup_ids, query_matrix):
+    """
+        Brute force search of a lookup matrix, given transposed as CSR (features x lookup rows),
+        returning (ids, confidences) arrays for each query row. Both sides are L2 normalized, so
+        the dot product is the same cosine similarity that nmslib returns (negated) for its hits.
+    """
+
+    # Both operands are CSR already, so scipy multiplies them without converting either one
+    scores = (query_matrix @ lookup_matrix_t).toarray()
+    return top_matches(scores, lookup_ids)
+
+
+def top_matches(scores, lookup_ids):
+    """
+        Pick the best MAX_RESULTS (ids, confidences) arrays for each row of a dense
+        (queries x lookup rows) score array, dropping rows that share no trigrams. lookup_ids
+        is either one id per score column, or a 2D array holding the id of each score.
+    """
+
+    # Partition out the top k in O(n) first, unless the whole index is no bigger than k
+    if scores.shape[1] > MAX_RESULTS:
+        top = np.argpartition(-scores, MAX_RESULTS - 1, axis=1)[:, :MAX_RESULTS]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        top_scores = scores
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_ids = np.take_along_axis(lookup_ids, top, axis=1) if lookup_ids.ndim == 2 else lookup_ids[top]
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    matches = top_scores > 0
+    return [(ids[hit], confidences[hit]) for ids, confidences, hit in zip(top_ids, top_scores, matches)]
+
+
+def group_starts(values):
+    """
+        Return the index of the first row of each run of equal values.
+    """
+
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.append(0, np.flatnonzero(np.diff(values)) + 1)
+
+
+def vectorize_chunk(artist_credit_ids, offsets, lookup_strings, lookup_ids):
+    """
+        Vectorize a chunk of artist credits in a worker process, where the rows of artist_credit_ids[i]
+        are offsets[i]:offsets[i + 1]. The whole chunk is vectorized in one call and returned as a single
+        CSR matrix. nmslib indexes cannot be pickled, so the parent creates them.
+    """
     t0 = monotonic()
-    results = []
-    for artist_credit_id, recording_data in thread_data:
-        recording_index = FuzzyIndex()
-        if len(recording_data) > 0:
-            recording_index.build(recording_data)
-            rows += len(recording_data)
-            results.append((artist_credit_id, recording_index))
+    lookup_matrix = FuzzyIndex.vectorizer.transform(lookup_strings)
     t1 = monotonic()
-    print("Indexed %d rows in %.2fs" % (rows, (t1-t0)))
-    return results
+    print("Vectorized %d rows in %.2fs" % (len(lookup_ids), (t1-t0)))
+    return artist_credit_ids, offsets, lookup_matrix, lookup_ids
 
 
 MAX_THREADS = 8
@@ -121,101 +329,202 @@ class MappingLookup:
         self.artist_data = {}
         self.return_value_queue = Queue()
 
-    def create_indexes(self, conn):
+    def create_indexes(self):
         t0 = monotonic()
-        last_artist_credit_id = -1
-        last_row = None
 
         futures = set()
-        thread_data = []
 
         self.recording_indexes = {}
-
-        # Read from CSV file, since no sort, faster to iterate
-        with open('canonical_musicbrainz_data.csv', newline='') as csvfile, \
-                ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            reader = csv.reader(csvfile)
-
-            recording_data = []
-            for i, csv_row in enumerate(reader):
-                if i == 0:
-                    continue
-
-                # Make the data look like it came from PG
-                row = { "id": int(csv_row[0]),
-                        "artist_credit_id": int(csv_row[1]),
-                        "artist_credit_name": csv_row[3],
-                        "recording_name": csv_row[7]
-                      }
-
-                if 0 <= last_artist_credit_id != row["artist_credit_id"]:
-                    thread_data.append((last_artist_credit_id, recording_data))
-                    recording_data = []
-                    self.artist_data[last_row["artist_credit_id"]] = (FuzzyIndex.encode_string(last_row["artist_credit_name"]),
-                                                                                               last_row["artist_credit_id"])
-
-                encoded = FuzzyIndex.encode_string(row["recording_name"])
-                if encoded:
-                    recording_data.append((encoded, row["id"]))
-                last_row = row
-                last_artist_credit_id = row["artist_credit_id"]
-
-                if i and i % CHUNK_SIZE == 0:
-                    future = executor.submit(build_index, thread_data)
-                    futures.add(future)
-                    thread_data = []
+        packed_chunks = []
+
+        # Read the columns we need from the CSV file in one vectorized pass
+        df = pd.read_csv('canonical_musicbrainz_data.csv',
+                         usecols=[0, 1, 3, 7],
+                         dtype={0: "int64", 1: "int64", 3: str, 7: str},
+                         keep_default_na=False)
+        df.columns = ["id", "artist_credit_id", "artist_credit_name", "recording_name"]
+
+        # Artist credit boundaries are found with np.diff below, so each credit's rows must be contiguous
+        if not df["artist_credit_id"].is_monotonic_increasing:
+            df = df.sort_values("artist_credit_id", kind="stable")
+
+        artist_credit_ids = df["artist_credit_id"].to_numpy()
+        last_rows = group_starts(artist_credit_ids)[1:] - 1
+        if len(artist_credit_ids):
+            last_rows = np.append(last_rows, len(artist_credit_ids) - 1)
+        for artist_credit_id, artist_credit_name in zip(artist_credit_ids[last_rows].tolist(),
+                                                        encode_strings(df["artist_credit_name"].to_numpy()[last_rows])):
+            self.artist_data[artist_credit_id] = (artist_credit_name, artist_credit_id)
+
+        encoded = encode_strings(df["recording_name"].to_numpy())
+        keep = encoded != ""
+        lookup_strings = encoded[keep]
+        lookup_ids = df["id"].to_numpy()[keep]
+        artist_credit_ids = artist_credit_ids[keep]
+
+        # Split the rows into chunks of about CHUNK_SIZE rows, without splitting an artist credit
+        starts = group_starts(artist_credit_ids)
+        bounds = np.append(starts, len(artist_credit_ids))
+        chunk_bounds = np.unique(np.append(np.searchsorted(starts, np.arange(0, len(lookup_ids), CHUNK_SIZE)),
+                                           len(starts)))
+
+        with ProcessPoolExecutor(max_workers=MAX_THREADS) as executor:
+            for first, last in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+                start, end = bounds[first], bounds[last]
+                futures.add(executor.submit(vectorize_chunk,
+                                            artist_credit_ids[starts[first:last]],
+                                            bounds[first:last + 1] - start,
+                                            lookup_strings[start:end],
+                                            lookup_ids[start:end]))
 
             for future in as_completed(futures):
-                results = future.result()
-                for ac_id, index in results:
-                    self.recording_indexes[ac_id] = index
-                futures.remove(future)
+                chunk_ac_ids, chunk_offsets, chunk_matrix, chunk_ids = future.result()
+                for ac_id, start, end in zip(chunk_ac_ids.tolist(), chunk_offsets[:-1].tolist(), chunk_offsets[1:].tolist()):
+                    if end - start >= BRUTE_FORCE_THRESHOLD:
+                        index = FuzzyIndex()
+                        index.load(chunk_matrix[start:end], chunk_ids[start:end])
+                        self.recording_indexes[ac_id] = index
+                packed_chunks.append((chunk_ac_ids, chunk_offsets, chunk_matrix, chunk_ids))
+
+        # Drop the references to the chunk matrices once they have been packed
+        self.pack_recording_indexes(packed_chunks)
+        packed_chunks = None
 
-        # TODO: save last generated chunk
         # TODO: VA and more complex artist credits probably not handled correctly
 
-        self.artist_index = FuzzyIndex()
+        self.artist_index = ArtistIndex()
         self.artist_index.build(self.artist_data.values())
         t1 = monotonic()
         print("built indexes in %.1f seconds." % (t1 - t0))
 
+    def pack_recording_indexes(self, chunks):
+        """
+            Concatenate the vectorized chunks into one CSR matrix and id array for all the artist
+            credits that did not get their own FuzzyIndex, with the row range of each artist credit
+            kept in recording_offsets. This saves keeping a FuzzyIndex and scipy matrix alive for
+            each of the hundreds of thousands of small artists.
+        """
+
+        self.recording_offsets = {}
+        matrices = []
+        ids = []
+        row = 0
+        for artist_credit_ids, offsets, lookup_matrix, lookup_ids in chunks:
+            keep = []
+            for ac_id, start, end in zip(artist_credit_ids.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+                if ac_id in self.recording_indexes:
+                    continue
+                self.recording_offsets[ac_id] = (row, row + end - start)
+                row += end - start
+                keep.append(np.arange(start, end))
+
+            if keep:
+                keep = np.concatenate(keep)
+                matrices.append(lookup_matrix[keep])
+                ids.append(lookup_ids[keep])
+
+        if matrices:
+            self.recording_matrix = vstack(matrices, format="csr")
+            self.recording_ids = np.concatenate(ids)
+        else:
+            self.recording_matrix = csr_matrix((0, FuzzyIndex.vectorizer.n_features), dtype=FuzzyIndex.vectorizer.dtype)
+            self.recording_ids = np.empty(0, dtype=np.int64)
+
     def search(self, artist_name, recording_name):
+        return self.search_batch([(artist_name, recording_name)])[0]
 
-        # First do artist fuzzy search, which takes 1-2ms with a full index.
-        artist_name = FuzzyIndex.encode_string(artist_name)
-        recording_name = FuzzyIndex.encode_string(recording_name)
-        artists = self.artist_index.search(artist_name)
-        results = []
+    def search_batch(self, queries):
+        """
+            Search a list of (artist_name, recording_name) queries. All artist lookups go to the
+            artist index in one batch, then the recording lookups are grouped so that each
+            recording index is queried once. Returns a list of results, one per query.
+        """
 
-        # For each hit, search recordings.
-        for artist in artists:
-            artist["id"] = int(artist["id"])
-            artist["text"] = self.artist_data[artist["id"]][0]
-            if artist["confidence"] > ARTIST_CONFIDENCE_THRESHOLD:
-                print("search recordings for: ", artist["text"])
-                search_index = self.recording_indexes[artist["id"]]
+        # First do artist fuzzy search, which takes 1-2ms with a full index.
+        artist_names = [encode_string(artist_name) for artist_name, _ in queries]
+        recording_names = [encode_string(recording_name) for _, recording_name in queries]
+        artist_hits = self.artist_index.search(artist_names)
+
+        # Group the recording searches by the artist credit whose index they need.
+        pending = {}
+        for i, artists in enumerate(artist_hits):
+            for artist in artists:
+                artist["text"] = self.artist_data[artist["id"]][0]
+                if artist["confidence"] > ARTIST_CONFIDENCE_THRESHOLD:
+                    pending.setdefault(artist["id"], []).append((i, artist))
+
+        # Vectorize the recording names once, then score every (recording row, query) pair that
+        # is needed for the packed artists in a single sparse pass, rather than one per artist.
+        # Only pairs where the artist was a hit for that query are scored.
+        recording_vectors = FuzzyIndex.vectorizer.transform(recording_names)
+        pair_rows = []
+        pair_queries = []
+        for artist_credit_id, hits in pending.items():
+            if artist_credit_id in self.recording_offsets:
+                start, end = self.recording_offsets[artist_credit_id]
+                for i, _ in hits:
+                    pair_rows.append(np.arange(start, end))
+                    pair_queries.append(np.full(end - start, i))
+        if pair_rows:
+            pair_rows = np.concatenate(pair_rows)
+            pair_queries = np.concatenate(pair_queries)
+            if len(queries) == 1:
+                # A lone query is cheapest as one dense vector, without repeating it per row
+                pair_scores = self.recording_matrix[pair_rows] @ recording_vectors.toarray().ravel()
+            else:
+                pair_scores = np.asarray(self.recording_matrix[pair_rows]
+                                         .multiply(recording_vectors[pair_queries])
+                                         .sum(axis=1)).ravel()
+        pair = 0
+
+        # For each hit, search recordings, keeping the matches by (query, artist credit).
+        found = {}
+        for artist_credit_id, hits in pending.items():
+            print("search recordings for: ", hits[0][1]["text"])
+            query_rows = [i for i, _ in hits]
+            if artist_credit_id in self.recording_offsets:
+                start, end = self.recording_offsets[artist_credit_id]
+                size = (end - start) * len(query_rows)
+                matches = top_matches(pair_scores[pair:pair + size].reshape(len(query_rows), end - start),
+                                      self.recording_ids[start:end])
+                pair += size
+            else:
+                search_index = self.recording_indexes.get(artist_credit_id)
 
                 # check to see if the artist was indexed
                 if search_index is None:
                     print("artist not indexed")
-                    return []
-                rec_results = search_index.search(FuzzyIndex.encode_string(recording_name))
-                for result in rec_results:
-                    results.append({ "artist_name": artist["text"],
-                                     "artist_credit_id": artist["id"],
-                                     "artist_confidence": artist["confidence"],
-                                     "recording_name": result["text"],
-                                     "canonical_id": result["id"],
-                                     "recording_confidence": result["confidence"] })
+                    continue
+
+                matches = search_index.match_vectors(recording_vectors[query_rows])
+
+            for (i, _), query_matches in zip(hits, matches):
+                found[(i, artist_credit_id)] = query_matches
+
+        # Only build dicts for the results we actually return, in each query's own artist ranking
+        results = []
+        for i, artists in enumerate(artist_hits):
+            query_results = []
+            for artist in artists:
+                if (i, artist["id"]) not in found:
+                    continue
+                ids, confidences = found[(i, artist["id"])]
+                for canonical_id, confidence in zip(ids.tolist(), confidences.tolist()):
+                    query_results.append({ "artist_name": artist["text"],
+                                           "artist_credit_id": artist["id"],
+                                           "artist_confidence": artist["confidence"],
+                                           "recording_name": recording_names[i],
+                                           "canonical_id": canonical_id,
+                                           "recording_confidence": confidence })
+            results.append(query_results)
 
         return results
 
 
-mi = MappingLookup()
+if __name__ == "__main__":
+    mi = MappingLookup()
+    mi.create_indexes()
 
-with psycopg2.connect(DB_CONNECT) as conn:
-    with parallel_backend("loky", n_jobs=MAX_THREADS):
-        mi.create_indexes(conn)
     while True:
         query = input("artist,recording>")
         if not query:
@@ -235,5 +544,5 @@ with psycopg2.connect(DB_CONNECT) as conn:
                                                      result["recording_name"],
                                                      result["recording_confidence"],
                                                      result["canonical_id"]))
-            
+
         print("%.3fms" % ((t1 - t0) * 1000))
@@ -19,7 +19,6 @@ def main():
         for future in as_completed(futures):
             idx, time = future.result()
             print(f"Task {idx}: slept {time}")
-            futures.remove(future)
 
 
 if __name__ == "__main__":